@@ -11,9 +11,32 @@ from __future__ import annotations
 import argparse
 import json
 import shutil
+import struct
 import subprocess
 import sys
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import Iterator
+
+try:
+    import orjson
+except ImportError:  # optional; falls back to a cached stdlib encoder
+    orjson = None
+
+if orjson is not None:
+
+    def dumps_sorted(obj: dict) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+
+else:
+    # Same compact, key-sorted output as orjson so the JSONL is identical either way.
+    _ENCODER = json.JSONEncoder(sort_keys=True, separators=(",", ":"))
+
+    def dumps_sorted(obj: dict) -> bytes:
+        return _ENCODER.encode(obj).encode()
+
+# Observed structure in Anker captures:
+# ff 09 <len_le:2> <word0_le:2> <word1_le:2> ...
+FF09_HEADER = struct.Struct("<2xHHH")
 
 
 @dataclass(frozen=True)
@@ -24,21 +47,20 @@ class AttRow:
     att_handle: str
     value_hex: str
 
-    def as_json(self) -> str:
-        b = bytes.fromhex(self.value_hex) if self.value_hex else b""
+    def as_json(self) -> bytes:
         hdr = None
-        if len(b) >= 8 and b[:2] == b"\xFF\x09":
-            # Observed structure in Anker captures:
-            # ff 09 <len_le:2> <...>
-            decl_len = int.from_bytes(b[2:4], "little")
+        # value_hex is normalized to lowercase without separators, so the magic and
+        # length checks can run on the string; only the 8 header bytes get decoded.
+        if len(self.value_hex) >= 16 and self.value_hex.startswith("ff09"):
+            decl_len, word0, word1 = FF09_HEADER.unpack(bytes.fromhex(self.value_hex[:16]))
             hdr = {
                 "magic": "ff09",
                 "decl_len_le": decl_len,
-                "actual_len": len(b),
-                "word0_le": int.from_bytes(b[4:6], "little"),
-                "word1_le": int.from_bytes(b[6:8], "little"),
+                "actual_len": len(self.value_hex) // 2,
+                "word0_le": word0,
+                "word1_le": word1,
             }
-        return json.dumps(
+        return dumps_sorted(
             {
                 "frame": self.frame,
                 "t_epoch": self.t_epoch,
@@ -46,14 +68,17 @@ class AttRow:
                 "att_handle": self.att_handle,
                 "value_hex": self.value_hex,
                 "ff09_header": hdr,
-            },
-            sort_keys=True,
+            }
         )
 
 
-def run(*cmd: str) -> str:
-    p = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
-    return p.stdout
+def run_lines(*cmd: str) -> Iterator[str]:
+    # Stream stdout so callers can start parsing while tshark is still dissecting.
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True) as p:
+        assert p.stdout is not None
+        yield from p.stdout
+    if p.returncode:
+        raise subprocess.CalledProcessError(p.returncode, cmd)
 
 
 def require_tshark() -> str:
@@ -63,49 +88,43 @@ def require_tshark() -> str:
     return tshark
 
 
-def find_conn_handle(tshark: str, pcap: str, peer: str) -> str:
-    # Match reversed BD_ADDR bytes (as they appear in many HCI events).
-    peer_bytes = bytes(int(x, 16) for x in peer.split(":"))
-    rev = ":".join(f"{b:02x}" for b in peer_bytes[::-1])
+def parse_handle(s: str) -> int:
+    # tshark prints handles as "0x0040"; accept plain decimal as well.
+    return int(s, 16) if s.lower().startswith("0x") else int(s)
 
-    # LE Enhanced Connection Complete [v1] is subevent 0x0a.
-    out = run(
-        tshark,
-        "-r",
-        pcap,
-        "-Y",
-        f"bthci_evt.le_meta_subevent == 0x0a && frame contains {rev}",
-        "-T",
-        "fields",
-        "-E",
-        "separator=\t",
-        "-e",
-        "frame.number",
-        "-e",
-        "bthci_evt.connection_handle",
-    ).strip()
 
-    if not out:
-        raise SystemExit(f"Could not find LE Enhanced Connection Complete for peer {peer}")
+@dataclass
+class PeerConnection:
+    # Filled in by iter_peer_att as connection-complete events for the peer go by.
+    seen: bool = False
+    chandles: list[str] = field(default_factory=list)
 
-    # If multiple matches, pick the last (most recent).
-    last = out.splitlines()[-1]
-    _frame, ch = last.split("\t", 1)
-    if not ch:
-        raise SystemExit("Found connection complete, but no connection_handle field")
-    return ch
 
+def iter_peer_att(tshark: str, pcap: str, peer: str, conn: PeerConnection) -> Iterator[AttRow]:
+    """
+    Yield the peer's ATT PDUs from a single tshark pass, as they are parsed.
 
-def iter_att(tshark: str, pcap: str, chandle: str) -> list[AttRow]:
-    # Focus on payload-bearing opcodes by default:
+    Dissecting the capture is the expensive part, so connection-complete events and
+    ATT rows are pulled out together and told apart by which fields are populated.
+    A connection's ACL traffic always follows its Connection Complete, so rows are
+    only yielded while they are on the handle the peer's most recent connection
+    announced; nothing is buffered. `conn` collects every handle the peer used.
+    """
+    # Match reversed BD_ADDR bytes (as they appear in many HCI events).
+    peer_bytes = bytes(int(x, 16) for x in peer.split(":"))
+    rev = ":".join(f"{b:02x}" for b in peer_bytes[::-1])
+
+    # LE Enhanced Connection Complete [v1] is subevent 0x0a.
+    # For ATT, focus on payload-bearing opcodes by default:
     # 0x52 Write Command, 0x12 Write Request, 0x1b Handle Value Notification, 0x1d Indication,
     # 0x0b Read Response, 0x13 Write Response.
     filt = (
-        f"bthci_acl.chandle == {chandle} && "
+        f"(bthci_evt.le_meta_subevent == 0x0a && frame contains {rev}) || "
+        "(bthci_acl.chandle && "
         "(btatt.opcode == 0x52 || btatt.opcode == 0x12 || btatt.opcode == 0x1b || "
-        " btatt.opcode == 0x1d || btatt.opcode == 0x0b || btatt.opcode == 0x13)"
+        " btatt.opcode == 0x1d || btatt.opcode == 0x0b || btatt.opcode == 0x13))"
     )
-    out = run(
+    lines = run_lines(
         tshark,
         "-r",
         pcap,
@@ -125,29 +144,43 @@ def iter_att(tshark: str, pcap: str, chandle: str) -> list[AttRow]:
         "btatt.handle",
         "-e",
         "btatt.value",
-    ).strip()
-
-    rows: list[AttRow] = []
-    if not out:
-        return rows
+        "-e",
+        "bthci_acl.chandle",
+        "-e",
+        "bthci_evt.connection_handle",
+    )
 
-    for line in out.splitlines():
-        parts = line.split("\t")
-        if len(parts) < 5:
+    peer_handle = None
+    for line in lines:
+        parts = line.rstrip("\r\n").split("\t")
+        if len(parts) < 7:
+            continue
+        frame_s, t_epoch, opcode, att_handle, value, acl_handle, conn_handle = parts[:7]
+        if not opcode:
+            # Connection complete for the peer; its handle applies from here on.
+            conn.seen = True
+            if conn_handle:
+                if conn_handle not in conn.chandles:
+                    conn.chandles.append(conn_handle)
+                peer_handle = parse_handle(conn_handle)
+            continue
+        if peer_handle is None or not acl_handle or parse_handle(acl_handle) != peer_handle:
             continue
-        frame_s, t_epoch, opcode, att_handle, value = parts[:5]
         # tshark may emit bytes as "aa:bb:cc". Normalize to hex string without separators.
         value_hex = value.replace(":", "").strip().lower()
-        rows.append(
-            AttRow(
-                frame=int(frame_s),
-                t_epoch=t_epoch,
-                opcode=opcode,
-                att_handle=att_handle,
-                value_hex=value_hex,
-            )
+        yield AttRow(
+            frame=int(frame_s),
+            t_epoch=t_epoch,
+            opcode=opcode,
+            att_handle=att_handle,
+            value_hex=value_hex,
         )
-    return rows
+
+    if not conn.seen:
+        raise SystemExit(f"Could not find LE Enhanced Connection Complete for peer {peer}")
+    if not conn.chandles:
+        # Nothing was yielded: rows are only matched once a handle is known.
+        raise SystemExit("Found connection complete, but no connection_handle field")
 
 
 def main() -> int:
@@ -158,14 +191,18 @@ def main() -> int:
     args = ap.parse_args()
 
     tshark = require_tshark()
-    chandle = find_conn_handle(tshark, args.btsnoop, args.peer.lower())
-    rows = iter_att(tshark, args.btsnoop, chandle)
+    conn = PeerConnection()
+    rows = iter_peer_att(tshark, args.btsnoop, args.peer.lower(), conn)
 
     if args.jsonl:
+        out = sys.stdout.buffer
         for r in rows:
-            print(r.as_json())
+            out.write(r.as_json())
+            out.write(b"\n")
     else:
-        print(f"peer={args.peer} chandle={chandle} att_pdus={len(rows)}")
+        # The summary line needs the row count (and every peer handle) up front.
+        rows = list(rows)
+        print(f"peer={args.peer} chandle={','.join(conn.chandles)} att_pdus={len(rows)}")
         for r in rows:
             prefix = f"{r.frame}\t{r.t_epoch}\t{r.opcode}\t{r.att_handle}\t"
             print(prefix + (r.value_hex or ""))
@@ -20,12 +20,27 @@ from __future__ import annotations
 import argparse
 import json
 import string
+import struct
+from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass
+from functools import lru_cache, partial
+from itertools import islice
 from typing import Iterable
 
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
 
+try:
+    import orjson
+except ImportError:  # optional; stdlib json is fine, just slower on big captures
+    orjson = None
+
+json_loads = orjson.loads if orjson is not None else json.loads
+
+
+# ff 09 <decl_len:le16> 03 00 <group> <cmd_high> <cmd_low> ...
+FF09_FRAME = struct.Struct("<BBHBBBBB")
+
 
 def parse_hex(s: str) -> bytes:
     s = s.strip().lower().replace(":", "")
@@ -63,61 +78,114 @@ def tlv_parse(buf: bytes) -> tuple[int, int, list[tuple[int, bytes]]]:
     return off, errors, items
 
 
+GOOD_TLV_TYPES = frozenset((0xA1, 0xA2, 0xA3, 0xA4, 0xA5, 0xA6, 0xA7, 0xA8, 0xA9, 0xAE))
+PRINTABLE_ASCII = bytes(range(32, 127))
+
+
 def score_tlv_plaintext(pt: bytes) -> tuple[float, str]:
+    """
+    Score one candidate plaintext.
+
+    This walks the same [type][len][value] layout as tlv_parse(), but keeps only
+    counters instead of building an item list, since it runs once per
+    (offset, key, iv) candidate and almost all of them are rejected.
+    """
     # Optional leading 0x00 is seen in some implementations.
-    pt2 = pt[1:] if pt[:1] == b"\x00" else pt
+    start = 1 if pt[:1] == b"\x00" else 0
+    end = len(pt)
 
-    parsed, errors, items = tlv_parse(pt2)
-    if not items:
-        return 0.0, "no_tlvs"
+    off = start
+    errors = 0
+    n_items = 0
+    a_types = 0
+    good_types = 0
+    asciiish = 0
+    while off + 2 <= end:
+        t = pt[off]
+        l = pt[off + 1]
+        off += 2
+        if off + l > end:
+            errors += 1
+            break
+        n_items += 1
+        # Reward recognizable Anker TLV type range.
+        if t >= 0xA0:
+            a_types += 1
+            if t in GOOD_TLV_TYPES:
+                good_types += 1
+        # Reward if any value looks ASCII-ish (serial/firmware).
+        if l >= 6:
+            nonprintable = len(pt[off : off + l].translate(None, PRINTABLE_ASCII))
+            if (l - nonprintable) / l >= 0.85:
+                asciiish += 1
+        off += l
+    if off != end:
+        # trailing bytes are "error-ish"
+        errors += 1
 
-    # Reward recognizable Anker TLV type range.
-    a_types = sum(1 for (t, _v) in items if 0xA0 <= t <= 0xFF)
-    good_types = sum(1 for (t, _v) in items if t in (0xA1, 0xA2, 0xA3, 0xA4, 0xA5, 0xA6, 0xA7, 0xA8, 0xA9, 0xAE))
+    if not n_items:
+        return 0.0, "no_tlvs"
 
     # Filter out obvious random false-positives where we "parse" a single TLV by chance.
-    if len(items) == 1 and good_types == 0:
+    if n_items == 1 and good_types == 0:
         return 0.0, "single_tlv_unrecognized"
 
     # Require at least 2 TLVs unless we see a known-good type.
-    if len(items) < 2 and good_types == 0:
+    if n_items < 2 and good_types == 0:
         return 0.0, "too_few_tlvs"
 
-    # Reward if any value looks ASCII-ish (serial/firmware).
-    asciiish = 0
-    for _t, v in items:
-        if not v:
-            continue
-        printable = sum(1 for b in v if 32 <= b <= 126)
-        if printable / len(v) >= 0.85 and len(v) >= 6:
-            asciiish += 1
-
     # Parse coverage and penalty for parse errors.
-    coverage = parsed / max(1, len(pt2))
+    coverage = (off - start) / max(1, end - start)
     score = 10.0 * coverage
     score += 2.0 * a_types
     score += 4.0 * good_types
     score += 2.0 * asciiish
     score -= 10.0 * errors
+    if score <= 0:
+        return score, ""
 
-    # Summary string for debugging.
+    # Summary string for debugging (only built for candidates that are kept).
+    _parsed, _errors, items = tlv_parse(pt[start:])
     types = " ".join(f"{t:02x}({len(v)})" for (t, v) in items[:8])
     if len(items) > 8:
         types += f" ... (+{len(items)-8})"
     return score, types
 
 
+def xor_bytes(a: bytes, b: bytes) -> bytes:
+    n = min(len(a), len(b))
+    return (int.from_bytes(a[:n], "big") ^ int.from_bytes(b[:n], "big")).to_bytes(n, "big")
+
+
+@lru_cache(maxsize=None)
+def ecb_decryptor(key: bytes):
+    """
+    Long-lived AES-ECB decrypt context for `key`.
+
+    ECB carries no state between blocks, so `update()` can be called repeatedly on
+    the same context without ever finalizing it. This keeps cipher setup out of
+    the brute-force loop.
+    """
+    if len(key) != 16:
+        raise ValueError("key must be 16 bytes")
+    return Cipher(algorithms.AES(key), modes.ECB(), backend=default_backend()).decryptor()
+
+
+def cbc_unchain(pt_ecb: bytes, ct: bytes, iv: bytes) -> bytes:
+    # CBC plaintext block i = D(C[i]) ^ C[i-1], with C[-1] = IV.
+    return xor_bytes(pt_ecb[:16], iv) + xor_bytes(pt_ecb[16:], ct[:-16])
+
+
 def aes_cbc_decrypt(ct: bytes, key: bytes, iv: bytes) -> bytes:
     if len(key) != 16 or len(iv) != 16:
         raise ValueError("key/iv must be 16 bytes")
     if len(ct) % 16 != 0:
         raise ValueError("ciphertext must be 16-byte aligned")
-    cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
-    decryptor = cipher.decryptor()
-    return decryptor.update(ct) + decryptor.finalize()
+    return cbc_unchain(ecb_decryptor(key).update(ct), ct, iv)
 
 
-def iv_candidates(blob: bytes, peer_mac: bytes, k0: bytes, k1: bytes) -> list[tuple[str, bytes]]:
+def static_iv_candidates(peer_mac: bytes, k0: bytes, k1: bytes) -> list[tuple[str, bytes]]:
+    # IVs that do not depend on the frame; build these once per run.
     out: list[tuple[str, bytes]] = []
     out.append(("iv_zero", b"\x00" * 16))
     out.append(("iv_k0", k0))
@@ -125,6 +193,11 @@ def iv_candidates(blob: bytes, peer_mac: bytes, k0: bytes, k1: bytes) -> list[tu
     if len(peer_mac) == 6:
         out.append(("iv_peer_mac_pad0", peer_mac + b"\x00" * 10))
         out.append(("iv_peer_mac_rev_pad0", peer_mac[::-1] + b"\x00" * 10))
+    return out
+
+
+def blob_iv_candidates(blob: bytes) -> list[tuple[str, bytes]]:
+    out: list[tuple[str, bytes]] = []
     if len(blob) >= 16:
         out.append(("iv_blob0_16", blob[:16]))
     if len(blob) >= 4:
@@ -132,6 +205,10 @@ def iv_candidates(blob: bytes, peer_mac: bytes, k0: bytes, k1: bytes) -> list[tu
     return out
 
 
+def iv_candidates(blob: bytes, peer_mac: bytes, k0: bytes, k1: bytes) -> list[tuple[str, bytes]]:
+    return static_iv_candidates(peer_mac, k0, k1) + blob_iv_candidates(blob)
+
+
 def key_candidates(k0: bytes, k1: bytes) -> list[tuple[str, bytes]]:
     return [("key_k0", k0), ("key_k1", k1)]
 
@@ -155,17 +232,92 @@ class Candidate:
 
 def iter_ct_segments(blob: bytes, max_off: int = 32) -> Iterable[tuple[int, bytes]]:
     # Try reasonable offsets to account for small per-message headers.
-    max_off = min(max_off, len(blob))
-    for off in range(0, max_off + 1):
-        ct = blob[off:]
-        if len(ct) >= 16 and len(ct) % 16 == 0:
-            yield off, ct
-    # Also try taking the *tail* (common with MIC/tag prefixes).
+    # Only offsets leaving a whole number of blocks matter, so step by 16.
+    max_off = min(max_off, len(blob) - 16)
+    for off in range(len(blob) % 16, max_off + 1, 16):
+        yield off, blob[off:]
+    # Also try taking the *tail* (common with MIC/tag prefixes). Tails starting
+    # at or before max_off were already covered above.
     for tail_len in (16, 32, 48, 64, 80, 96, 112, 128):
-        if tail_len <= len(blob) and tail_len % 16 == 0:
+        if tail_len <= len(blob) and len(blob) - tail_len > max_off:
             yield len(blob) - tail_len, blob[-tail_len:]
 
 
+def iter_ff09_lines(path: str) -> Iterable[bytes]:
+    with open(path, "rb") as f:
+        for line in f:
+            # Cheap bytes prefilter: only lines that can hold an FF09 frame get decoded.
+            if b"ff09" in line:
+                yield line
+
+
+@lru_cache(maxsize=None)
+def search_setup(k0: bytes, k1: bytes, peer_mac: bytes) -> tuple[list, list[tuple[str, int]]]:
+    # Built once per process: one ECB context per key, and the frame-independent
+    # IVs as ints (IVs are only ever xor'ed into the first plaintext block).
+    keys = [(key_name, ecb_decryptor(key)) for key_name, key in key_candidates(k0, k1)]
+    static_ivs = [(iv_name, int.from_bytes(iv, "big")) for iv_name, iv in static_iv_candidates(peer_mac, k0, k1)]
+    return keys, static_ivs
+
+
+def frame_candidates(line: bytes, k0: bytes, k1: bytes, peer_mac: bytes, max_off: int) -> list[Candidate]:
+    """
+    Try every (offset, key, iv) combination on one JSONL row.
+
+    Rows are independent, so this is the unit of work handed to worker processes.
+    """
+    o = json_loads(line)
+    hx = o.get("value_hex") or ""
+    # Reject on the hex string so only real candidates pay for bytes.fromhex:
+    # at least 10 bytes, ff09 magic, and payload (raw[4:-1]) starting 03 00.
+    if len(hx) < 20 or not hx.startswith("ff09") or hx[8:12] != "0300":
+        return []
+
+    raw = bytes.fromhex(hx)
+    _m0, _m1, _decl_len, _p0, _p1, group, cmd_high, cmd_low = FF09_FRAME.unpack_from(raw)
+
+    cmd = (cmd_high << 8) | cmd_low
+    base_cmd = ((cmd_high & ~(0x40 | 0x08)) << 8) | cmd_low
+
+    blob = raw[FF09_FRAME.size : -1]
+    if not blob:
+        return []
+
+    keys, static_ivs = search_setup(k0, k1, peer_mac)
+    ivs = static_ivs + [(iv_name, int.from_bytes(iv, "big")) for iv_name, iv in blob_iv_candidates(blob)]
+
+    candidates: list[Candidate] = []
+    for ct_off, ct in iter_ct_segments(blob, max_off=max_off):
+        for key_name, ecb in keys:
+            # Everything past the first block is IV-independent.
+            pt_ecb = ecb.update(ct)
+            pt_rest = xor_bytes(pt_ecb[16:], ct[:-16])
+            pt_first = int.from_bytes(pt_ecb[:16], "big")
+            for iv_name, iv in ivs:
+                pt = (pt_first ^ iv).to_bytes(16, "big") + pt_rest
+                score, tlv_summary = score_tlv_plaintext(pt)
+                if score <= 0:
+                    continue
+                candidates.append(
+                    Candidate(
+                        score=score,
+                        frame=int(o.get("frame", -1)),
+                        opcode=str(o.get("opcode", "")),
+                        att_handle=str(o.get("att_handle", "")),
+                        group=group,
+                        cmd=cmd,
+                        base_cmd=base_cmd,
+                        ct_off=ct_off,
+                        ct_len=len(ct),
+                        key_name=key_name,
+                        iv_name=iv_name,
+                        pt0_hex=pt[:32].hex(),
+                        tlv_summary=tlv_summary,
+                    )
+                )
+    return candidates
+
+
 def main() -> int:
     ap = argparse.ArgumentParser()
     ap.add_argument("jsonl", help="JSONL output from extract_btsnoop_att.py --jsonl")
@@ -177,6 +329,7 @@ def main() -> int:
     )
     ap.add_argument("--top", type=int, default=15, help="Show top N candidates")
     ap.add_argument("--max-off", type=int, default=32, help="Max ciphertext start offset to try inside blob")
+    ap.add_argument("--jobs", type=int, default=1, help="Worker processes (default 1 = run in-process)")
     args = ap.parse_args()
 
     a2 = bytes.fromhex(args.a2)
@@ -189,67 +342,21 @@ def main() -> int:
     if args.peer:
         peer_mac = bytes(int(x, 16) for x in args.peer.split(":"))
 
-    candidates: list[Candidate] = []
+    search = partial(frame_candidates, k0=k0, k1=k1, peer_mac=peer_mac, max_off=args.max_off)
+    lines = iter_ff09_lines(args.jsonl)
 
-    for line in open(args.jsonl, "r", encoding="utf-8"):
-        o = json.loads(line)
-        hx = o.get("value_hex", "")
-        if not hx or not hx.startswith("ff09"):
-            continue
-
-        raw = bytes.fromhex(hx)
-        if len(raw) < 10:
-            continue
-        if raw[0] != 0xFF or raw[1] != 0x09:
-            continue
-
-        decl_len = int.from_bytes(raw[2:4], "little")
-        payload = raw[4:-1]  # includes 03 00 group cmdHigh cmdLow ...
-        if len(payload) < 5:
-            continue
-        if payload[0] != 0x03 or payload[1] != 0x00:
-            continue
-
-        group = payload[2]
-        cmd_high = payload[3]
-        cmd_low = payload[4]
-        cmd = (cmd_high << 8) | cmd_low
-        base_cmd = ((cmd_high & ~(0x40 | 0x08)) << 8) | cmd_low
-
-        blob = payload[5:]
-        if not blob:
-            continue
-
-        ivs = iv_candidates(blob, peer_mac, k0, k1)
-        keys = key_candidates(k0, k1)
-
-        for ct_off, ct in iter_ct_segments(blob, max_off=args.max_off):
-            for key_name, key in keys:
-                for iv_name, iv in ivs:
-                    try:
-                        pt = aes_cbc_decrypt(ct, key, iv)
-                    except Exception:
-                        continue
-                    score, tlv_summary = score_tlv_plaintext(pt)
-                    if score <= 0:
-                        continue
-                    candidates.append(
-                        Candidate(
-                            score=score,
-                            frame=int(o.get("frame", -1)),
-                            opcode=str(o.get("opcode", "")),
-                            att_handle=str(o.get("att_handle", "")),
-                            group=group,
-                            cmd=cmd,
-                            base_cmd=base_cmd,
-                            ct_off=ct_off,
-                            ct_len=len(ct),
-                            key_name=key_name,
-                            iv_name=iv_name,
-                            pt0_hex=pt[:32].hex(),
-                            tlv_summary=tlv_summary,
-                        )
-                    )
+    candidates: list[Candidate] = []
+    if args.jobs <= 1:
+        for sub in map(search, lines):
+            candidates.extend(sub)
+    else:
+        # Executor.map submits its whole input up front, so hand it bounded batches
+        # to keep only a few hundred lines in flight. Results come back in input
+        # order, so output matches the in-process run.
+        with ProcessPoolExecutor(max_workers=args.jobs) as ex:
+            while batch := list(islice(lines, args.jobs * 64)):
+                for sub in ex.map(search, batch, chunksize=16):
+                    candidates.extend(sub)
 
     candidates.sort(key=lambda c: c.score, reverse=True)
     for c in candidates[: args.top]:
@@ -16,12 +16,29 @@ from __future__ import annotations
 
 import argparse
 import json
+import struct
 import sys
-from dataclasses import dataclass
-from typing import Iterable, Optional
+from typing import Iterable, NamedTuple, Optional
+
+try:
+    import orjson
+except ImportError:  # optional; stdlib json is fine, just slower on big captures
+    orjson = None
+
+json_loads = orjson.loads if orjson is not None else json.loads
+
+
+# fixed64 / fixed32 wire types, decoded in place without slicing.
+unpack_u64 = struct.Struct("<Q").unpack_from
+unpack_u32 = struct.Struct("<I").unpack_from
 
 
 def read_varint(buf: bytes, off: int) -> tuple[int, int]:
+    # Fast path: most tags and small values fit in a single byte.
+    if off < len(buf):
+        b0 = buf[off]
+        if b0 < 0x80:
+            return b0, off + 1
     v = 0
     shift = 0
     start = off
@@ -35,37 +52,76 @@ def read_varint(buf: bytes, off: int) -> tuple[int, int]:
     raise ValueError(f"unterminated varint at {start}")
 
 
-def is_mostly_printable(b: bytes) -> bool:
-    if not b:
-        return False
-    printable = sum(1 for x in b if 32 <= x <= 126 or x in (9, 10, 13))
-    return printable / len(b) >= 0.85
+ASCII_PRINTABLE = bytes(range(32, 127))
+LOW_CONTROL_BYTES = bytes(range(9))
 
+# Kinds returned by classify_blob.
+BLOB_BINARY = 0
+BLOB_UTF8 = 1
+BLOB_ASCII = 2
+BLOB_EMBEDDED = 3
 
-def try_utf8(b: bytes) -> Optional[str]:
-    try:
-        s = b.decode("utf-8")
-    except Exception:
-        return None
-    # Keep this conservative.
-    if not s:
-        return None
-    if any(ord(ch) < 9 for ch in s):
-        return None
-    if sum(1 for ch in s if ch.isprintable()) / len(s) < 0.85:
-        return None
-    return s
+
+def classify_blob(b: bytes, allow_embedded: bool = True) -> tuple[int, Optional[str]]:
+    """
+    Classify a length-delimited payload as one of the BLOB_* kinds.
+
+    Returns (kind, text); text is set for BLOB_UTF8 and BLOB_ASCII. The checks run in
+    priority order (conservative UTF-8, then mostly-printable bytes, then the
+    nested-message probe), but share their byte counts: each translate() pass only
+    sees what the previous one left over.
+    """
+    n = len(b)
+    if not n:
+        return BLOB_BINARY, None
+    # Printable ASCII (32..126), then \t \n \r, then control bytes below 9.
+    rest = b.translate(None, ASCII_PRINTABLE)
+    ascii_printable = n - len(rest)
+    other = rest.translate(None, b"\t\n\r") if rest else rest
+    printable = n - len(other)
+    # In UTF-8, code points below 9 only ever appear as those raw bytes.
+    has_low_control = bool(other) and len(other.translate(None, LOW_CONTROL_BYTES)) != len(other)
+
+    if not has_low_control:
+        if b.isascii():
+            # For ASCII, str.isprintable() is exactly 32..126.
+            if ascii_printable / n >= 0.85:
+                return BLOB_UTF8, b.decode("ascii")
+        else:
+            try:
+                s = b.decode("utf-8")
+            except UnicodeDecodeError:
+                s = None
+            # Whole-string isprintable() settles the common case in one C call; otherwise
+            # count per character, still without a Python-level generator.
+            if s is not None and (s.isprintable() or sum(map(str.isprintable, s)) / len(s) >= 0.85):
+                return BLOB_UTF8, s
+
+    if printable / n >= 0.85:
+        return BLOB_ASCII, b.decode("latin1", errors="replace")
+    if allow_embedded and looks_like_embedded_message(b):
+        return BLOB_EMBEDDED, None
+    return BLOB_BINARY, None
 
 
 def looks_like_embedded_message(b: bytes) -> bool:
     # Heuristic: a few valid tags in sequence, no huge lengths.
+    if not b:
+        return False
+    # Cheap reject from the first tag byte alone: its low 3 bits are always the wire
+    # type, and a value below 8 means field 0. Either would fail the first probe below.
+    b0 = b[0]
+    if b0 < 8 or (b0 & 0x7) in (3, 4, 6, 7):
+        return False
+    n = len(b)
+    read = read_varint
     off = 0
     ok = 0
     try:
         for _ in range(5):
-            if off >= len(b):
+            if off >= n:
                 break
-            tag, off2 = read_varint(b, off)
+            tag, off2 = read(b, off)
             if tag == 0:
                 break
             field = tag >> 3
@@ -74,11 +130,11 @@ def looks_like_embedded_message(b: bytes) -> bool:
                 break
             off = off2
             if wt == 0:
-                _, off = read_varint(b, off)
+                _, off = read(b, off)
             elif wt == 1:
                 off += 8
             elif wt == 2:
-                ln, off = read_varint(b, off)
+                ln, off = read(b, off)
                 if ln > 4096:
                     break
                 off += ln
@@ -86,7 +142,7 @@ def looks_like_embedded_message(b: bytes) -> bool:
                 off += 4
             else:
                 break
-            if off > len(b):
+            if off > n:
                 break
             ok += 1
     except Exception:
@@ -94,8 +150,9 @@ def looks_like_embedded_message(b: bytes) -> bool:
     return ok >= 2
 
 
-@dataclass(frozen=True)
-class Field:
+class Field(NamedTuple):
+    # A NamedTuple rather than a frozen dataclass: parse_message builds one per wire
+    # field, and tuple construction is far cheaper than a dataclass __init__.
     field_no: int
     wire_type: int
     value: object
@@ -105,74 +162,100 @@ class Field:
 
 def parse_message(buf: bytes, *, depth: int = 0, max_fields: int = 200) -> list[Field]:
     fields: list[Field] = []
+    result = fields
+    # Embedded messages are parsed without recursing: the parent's position is pushed
+    # here, the child is parsed in the same loop, and the parent resumes when it ends.
+    suspended: list[tuple[bytes, int, int, list[Field], int, int]] = []
+    # Hot-loop locals; buf_len and append are rebound whenever buf/fields switch.
+    read = read_varint
+    buf_len = len(buf)
+    append = fields.append
     off = 0
     n = 0
-    while off < len(buf) and n < max_fields:
-        start = off
-        tag, off = read_varint(buf, off)
-        if tag == 0:
-            break
-        field_no = tag >> 3
-        wt = tag & 0x7
-        if wt == 0:
-            v, off = read_varint(buf, off)
-            fields.append(Field(field_no, wt, v, start, off))
-        elif wt == 1:
-            if off + 8 > len(buf):
-                break
-            v = int.from_bytes(buf[off : off + 8], "little")
-            off2 = off + 8
-            fields.append(Field(field_no, wt, v, start, off2))
-            off = off2
-        elif wt == 2:
-            ln, off = read_varint(buf, off)
-            if off + ln > len(buf):
+    while True:
+        while off < buf_len and n < max_fields:
+            start = off
+            tag, off = read(buf, off)
+            if tag == 0:
                 break
-            b = buf[off : off + ln]
-            off2 = off + ln
-
-            # Attempt interpretations.
-            interp: dict[str, object] = {"len": ln, "hex": b.hex()}
-            s = try_utf8(b)
-            if s is not None:
-                interp["utf8"] = s
-            elif is_mostly_printable(b):
-                interp["ascii"] = b.decode("latin1", errors="replace")
-            elif looks_like_embedded_message(b) and depth < 3:
-                interp["embedded"] = [f for f in parse_message(b, depth=depth + 1, max_fields=50)]
-
-            fields.append(Field(field_no, wt, interp, start, off2))
-            off = off2
-        elif wt == 5:
-            if off + 4 > len(buf):
+            field_no = tag >> 3
+            wt = tag & 0x7
+            if wt == 0:
+                v, off = read(buf, off)
+                append(Field(field_no, wt, v, start, off))
+            elif wt == 1:
+                if off + 8 > buf_len:
+                    break
+                (v,) = unpack_u64(buf, off)
+                off2 = off + 8
+                append(Field(field_no, wt, v, start, off2))
+                off = off2
+            elif wt == 2:
+                ln, off = read(buf, off)
+                # Bound the length by what is left, so absurd lengths are rejected
+                # before any slice is attempted.
+                if ln > buf_len - off:
+                    break
+                b = buf[off : off + ln]
+                off2 = off + ln
+
+                # Attempt interpretations. The value is a flat (len, raw, kind, payload)
+                # tuple; payload is the text for BLOB_UTF8/BLOB_ASCII and the nested
+                # field list for BLOB_EMBEDDED. The raw slice is kept as-is; fmt_fields
+                # only hex-encodes the prefix it prints.
+                kind, text = classify_blob(b, allow_embedded=depth < 3)
+                if kind == BLOB_EMBEDDED:
+                    embedded: list[Field] = []
+                    append(Field(field_no, wt, (ln, b, kind, embedded), start, off2))
+                    suspended.append((buf, off2, n + 1, fields, depth, max_fields))
+                    buf, off, n, fields, depth, max_fields = b, 0, 0, embedded, depth + 1, 50
+                    buf_len = ln
+                    append = embedded.append
+                    continue
+
+                append(Field(field_no, wt, (ln, b, kind, text), start, off2))
+                off = off2
+            elif wt == 5:
+                if off + 4 > buf_len:
+                    break
+                (v,) = unpack_u32(buf, off)
+                off2 = off + 4
+                append(Field(field_no, wt, v, start, off2))
+                off = off2
+            else:
                 break
-            v = int.from_bytes(buf[off : off + 4], "little")
-            off2 = off + 4
-            fields.append(Field(field_no, wt, v, start, off2))
-            off = off2
-        else:
-            break
-        n += 1
-    return fields
+            n += 1
+        if not suspended:
+            return result
+        buf, off, n, fields, depth, max_fields = suspended.pop()
+        buf_len = len(buf)
+        append = fields.append
 
 
 def fmt_fields(fields: list[Field], indent: str = "") -> str:
     lines: list[str] = []
+    append_field_lines(fields, indent, lines)
+    return "\n".join(lines)
+
+
+def append_field_lines(fields: list[Field], indent: str, lines: list[str]) -> None:
+    # Embedded messages append into the same list, so nested output is joined once
+    # at the top instead of once per level.
     for f in fields:
-        if f.wire_type == 2 and isinstance(f.value, dict) and "embedded" in f.value:
-            lines.append(f"{indent}{f.field_no}: wt=2 len={f.value.get('len')} embedded:")
-            embedded = f.value["embedded"]
-            lines.append(fmt_fields(embedded, indent + "  "))
-        elif f.wire_type == 2 and isinstance(f.value, dict):
+        if f.wire_type == 2:
+            ln, raw, kind, payload = f.value
+            if kind == BLOB_EMBEDDED:
+                lines.append(f"{indent}{f.field_no}: wt=2 len={ln} embedded:")
+                append_field_lines(payload, indent + "  ", lines)
+                continue
             tail = ""
-            if "utf8" in f.value:
-                tail = f" utf8={f.value['utf8']!r}"
-            elif "ascii" in f.value:
-                tail = f" ascii={f.value['ascii']!r}"
-            lines.append(f"{indent}{f.field_no}: wt=2 len={f.value.get('len')} hex={f.value.get('hex')[:64]}{tail}")
+            if kind == BLOB_UTF8:
+                tail = f" utf8={payload!r}"
+            elif kind == BLOB_ASCII:
+                tail = f" ascii={payload!r}"
+            lines.append(f"{indent}{f.field_no}: wt=2 len={ln} hex={raw[:32].hex()}{tail}")
         else:
             lines.append(f"{indent}{f.field_no}: wt={f.wire_type} value={f.value}")
-    return "\n".join(lines)
 
 
 def dump_hex(label: str, buf: bytes) -> None:
@@ -199,25 +282,26 @@ def main() -> int:
         return 0
 
     if args.jsonl:
-        for line in open(args.jsonl, "r", encoding="utf-8"):
-            o = json.loads(line)
+        for line in open(args.jsonl, "rb"):
+            # Only FF09 frames get dumped; skip everything else before JSON-decoding it.
+            # value_hex may be written in either case.
+            if b"ff09" not in line and b"FF09" not in line:
+                continue
+            o = json_loads(line)
             if args.frame and int(o.get("frame", 0)) != args.frame:
                 continue
-            hx = o.get("value_hex", "")
-            if not hx:
+            hx = (o.get("value_hex") or "").lower()
+            # Check length, ff09 magic and the 03 00 payload prefix (payload = raw[4:-1])
+            # on the hex string, so rejected frames are never decoded.
+            if len(hx) < 20 or not hx.startswith("ff09") or hx[8:12] != "0300":
                 continue
             raw = bytes.fromhex(hx)
-            if len(raw) < 10 or raw[:2] != b"\xff\x09":
-                continue
-            payload = raw[4:-1]
-            if len(payload) < 5 or payload[:2] != b"\x03\x00":
-                continue
-            group = payload[2]
-            cmd_high = payload[3]
-            cmd_low = payload[4]
+            group = raw[6]
+            cmd_high = raw[7]
+            cmd_low = raw[8]
             cmd = (cmd_high << 8) | cmd_low
             base_cmd = ((cmd_high & ~(0x40 | 0x08)) << 8) | cmd_low
-            blob = payload[5:]
+            blob = raw[9:-1]
             print(f"frame={o.get('frame')} op={o.get('opcode')} h={o.get('att_handle')} group=0x{group:02x} cmd=0x{cmd:04x} base=0x{base_cmd:04x} blob_len={len(blob)}")
             dump_hex("  blob", blob)
             print()